@@ -2,16 +2,24 @@ import base64
 import json
 import os
 import random
+import threading
 import time
 import uuid
-import urllib.error
-import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
 from shutil import copy2
 
+import requests
 from flask import Flask, redirect, render_template, request, session, url_for
 from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import inspiration_tags
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -22,6 +30,26 @@ ALBUM_DIR = os.path.join(APP_ROOT, "static", "album_images")
 app = Flask(__name__)
 app.secret_key = os.environ.get("SMILE_SECRET", "smile-secret-key")
 
+# Prompt log tallies: (inode, mtime_ns, size) key, bytes consumed, entry count, protagonist count.
+_PROMPT_LOG_CACHE: tuple[tuple[int, int, int], int, int, int] | None = None
+
+# Most recent album directory scan, keyed by the directory mtime.
+_ALBUM_LISTING: tuple[int, list[str]] | None = None
+
+# Image requests run here; finished futures wait in GENERATION_JOBS until polled.
+GENERATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SMILE_GENERATION_WORKERS", "8")),
+    thread_name_prefix="smile-generate",
+)
+GENERATION_JOBS: dict[str, tuple[Future, float]] = {}
+GENERATION_JOB_TTL_SECONDS = 600
+MAX_PENDING_JOBS = 5
+_INSPIRATION_LOCK = threading.Lock()
+
+# Pooled keep-alive connections to the image API, shared by the generation threads.
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 
 CATEGORIES = {
     "actor_protagonist": inspiration_tags.ACTOR_PROTGONIST,
@@ -33,6 +61,11 @@ CATEGORIES = {
     "villan": inspiration_tags.VILLAN,
 }
 
+# The tag lists are static, so the (min, max) tag count per category is fixed at import.
+PICK_RANGES = {
+    category: (1, max(1, min(2, len(options)))) for category, options in CATEGORIES.items()
+}
+
 
 # Ensure storage directories are ready for the app lifecycle.
 def init_storage() -> None:
@@ -40,42 +73,48 @@ def init_storage() -> None:
     os.makedirs(ALBUM_DIR, exist_ok=True)
 
 
-def weighted_choice(category: str, options: list[str]) -> str:
-    return random.choice(options)
-
-
+# Every tag is equally weighted, so a plain sample without replacement suffices.
 def weighted_choices(category: str, options: list[str], count: int) -> list[str]:
-    selections = []
-    remaining = list(options)
-    for _ in range(min(count, len(remaining))):
-        pick = weighted_choice(category, remaining)
-        selections.append(pick)
-        remaining.remove(pick)
-    return selections
-
+    return random.sample(options, k=min(count, len(options)))
 
-def pick_count(options: list[str], max_count: int = 2) -> int:
-    if len(options) < 2:
-        return 1
-    return random.randint(1, min(max_count, len(options)))
 
-
-def load_prompt_entries() -> list[str]:
-    if not os.path.exists(PROMPT_LOG_PATH):
-        return []
-    with open(PROMPT_LOG_PATH, "r", encoding="utf-8") as log_file:
-        content = log_file.read()
-    entries = [entry.strip() for entry in content.split("\n\n") if entry.strip()]
-    return entries
+def pick_count(category: str) -> int:
+    return random.randint(*PICK_RANGES[category])
 
 
-def load_recent_prompt_entries(limit: int) -> list[str]:
-    entries = load_prompt_entries()
-    return entries[-limit:]
+def split_prompt_entries(content: str) -> list[str]:
+    return [entry.strip() for entry in content.split("\n\n") if entry.strip()]
 
 
-def recent_entries_contain_any(entries: list[str], tags: list[str]) -> bool:
-    return any(tag in entry for entry in entries for tag in tags)
+# Return how many prompts were logged and how many of them featured a protagonist.
+def load_prompt_log() -> tuple[int, int]:
+    global _PROMPT_LOG_CACHE
+    try:
+        log_stat = os.stat(PROMPT_LOG_PATH)
+    except FileNotFoundError:
+        return 0, 0
+    log_key = (log_stat.st_ino, log_stat.st_mtime_ns, log_stat.st_size)
+    cached_key, offset, entry_count, protagonist_entries = _PROMPT_LOG_CACHE or (None, 0, 0, 0)
+    if cached_key == log_key:
+        return entry_count, protagonist_entries
+    # The log is append-only, so only the bytes written since the last read need parsing.
+    if cached_key is None or cached_key[0] != log_stat.st_ino or log_stat.st_size < offset:
+        offset, entry_count, protagonist_entries = 0, 0, 0
+    with open(PROMPT_LOG_PATH, "rb") as log_file:
+        log_file.seek(offset)
+        appended = log_file.read()
+    new_entries = split_prompt_entries(appended.decode("utf-8"))
+    entry_count += len(new_entries)
+    protagonist_entries += count_entries_containing_any(
+        new_entries, inspiration_tags.ACTOR_PROTGONIST
+    )
+    _PROMPT_LOG_CACHE = (
+        log_key,
+        offset + len(appended),
+        entry_count,
+        protagonist_entries,
+    )
+    return entry_count, protagonist_entries
 
 
 def count_entries_containing_any(entries: list[str], tags: list[str]) -> int:
@@ -84,11 +123,7 @@ def count_entries_containing_any(entries: list[str], tags: list[str]) -> int:
 
 # Pick a themed set of inspiration tags for the prompt.
 def generate_inspiration() -> dict[str, list[str]]:
-    all_entries = load_prompt_entries()
-    total_entries = len(all_entries)
-    actor_protagonist_entries = count_entries_containing_any(
-        all_entries, inspiration_tags.ACTOR_PROTGONIST
-    )
+    total_entries, actor_protagonist_entries = load_prompt_log()
     include_actor_protagonist = (total_entries + 1) % 4 == 0
     include_villan = include_actor_protagonist and (actor_protagonist_entries + 1) % 3 == 0
     return {
@@ -104,12 +139,12 @@ def generate_inspiration() -> dict[str, list[str]]:
         "actor_supporting": weighted_choices(
             "actor_supporting",
             inspiration_tags.ACTOR_SUPPORTING,
-            pick_count(inspiration_tags.ACTOR_SUPPORTING),
+            pick_count("actor_supporting"),
         ),
         "activities": weighted_choices(
             "activities",
             inspiration_tags.ACTIVITIES,
-            pick_count(inspiration_tags.ACTIVITIES),
+            pick_count("activities"),
         ),
         "areas": weighted_choices(
             "areas",
@@ -119,7 +154,7 @@ def generate_inspiration() -> dict[str, list[str]]:
         "accessories": weighted_choices(
             "accessories",
             inspiration_tags.ACCESSORIES,
-            pick_count(inspiration_tags.ACCESSORIES),
+            pick_count("accessories"),
         ),
         "art_style": weighted_choices(
             "art_style",
@@ -146,7 +181,7 @@ def generate_image(selections: dict[str, list[str]]) -> str:
     unique_id = uuid.uuid4().hex
     filename = f"smile_{unique_id}.png"
     filepath = os.path.join(GENERATED_DIR, filename)
-    image.convert("RGB").save(filepath, format="PNG")
+    image.save(filepath, format="PNG", compress_level=1, optimize=False)
     return f"generated/{filename}"
 
 
@@ -158,44 +193,62 @@ def generate_ai_image(selections: dict[str, list[str]], width: int, height: int)
 
     model = os.environ.get("SMILE_IMAGE_MODEL", "gpt-image-1")
     prompt = build_prompt(selections)
-    log_prompt(selections)
     payload = {
         "model": model,
         "prompt": prompt,
         "size": os.environ.get("SMILE_IMAGE_SIZE", "1024x1024"),
     }
-    request_data = json.dumps(payload).encode("utf-8")
-    request = urllib.request.Request(
-        os.environ.get("SMILE_IMAGE_API_URL", "https://api.openai.com/v1/images/generations"),
-        data=request_data,
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-        method="POST",
-    )
-
+    if model.startswith("dall-e"):
+        # DALL-E can hand back a URL, skipping the base64 inflation; gpt-image models reject this field.
+        payload["response_format"] = "url"
+    request_data = dump_json(payload)
     try:
-        with urllib.request.urlopen(request, timeout=120) as response:
-            response_body = response.read()
-    except urllib.error.HTTPError as exc:
-        error_body = exc.read().decode("utf-8")
-        raise RuntimeError(f"Image generation failed: {error_body}") from exc
-    except urllib.error.URLError as exc:
-        raise RuntimeError(f"Image generation failed: {exc.reason}") from exc
-
-    data = json.loads(response_body.decode("utf-8"))
+        response = HTTP_SESSION.post(
+            os.environ.get("SMILE_IMAGE_API_URL", "https://api.openai.com/v1/images/generations"),
+            data=request_data,
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            timeout=120,
+        )
+    except requests.RequestException as exc:
+        raise RuntimeError(f"Image generation failed: {exc}") from exc
+    if response.status_code >= 400:
+        raise RuntimeError(f"Image generation failed: {response.text}")
+
+    response_body = response.content
+    data = load_json(response_body)
     image_data = data.get("data", [])
     if not image_data:
         raise RuntimeError("Image generation failed: no image data returned.")
 
     encoded = image_data[0].get("b64_json")
-    if not encoded:
+    image_url = image_data[0].get("url")
+    if encoded:
+        image_buffer = BytesIO(base64.b64decode(encoded))
+    elif image_url:
+        image_buffer = BytesIO(download_image(image_url))
+    else:
         raise RuntimeError("Image generation failed: missing image payload.")
-
-    raw_bytes = base64.b64decode(encoded)
-    with Image.open(BytesIO(raw_bytes)) as generated:
+    # Release the response body and base64 text before Pillow allocates the decoded pixels.
+    del response, response_body, data, image_data, encoded
+    with Image.open(image_buffer) as generated:
+        # Lets JPEG payloads decode at reduced scale; a no-op for PNG.
+        generated.draft("RGB", (width, height))
         generated = generated.convert("RGB")
+        if generated.size == (width, height):
+            return generated
+        if generated.width >= width or generated.height >= height:
+            # Downscaling: thumbnail shrinks in place without the extra copy ImageOps.pad makes.
+            generated.thumbnail((width, height), Image.LANCZOS)
+            padded = Image.new("RGB", (width, height), "#ffffff")
+            # Round the offsets the way ImageOps.pad does so odd margins land identically.
+            padded.paste(
+                generated,
+                (round((width - generated.width) * 0.5), round((height - generated.height) * 0.5)),
+            )
+            return padded
         return ImageOps.pad(
             generated,
             (width, height),
@@ -205,8 +258,37 @@ def generate_ai_image(selections: dict[str, list[str]], width: int, height: int)
         )
 
 
+def download_image(url: str) -> bytes:
+    try:
+        response = HTTP_SESSION.get(url, timeout=120)
+    except requests.RequestException as exc:
+        raise RuntimeError(f"Image download failed: {exc}") from exc
+    if response.status_code >= 400:
+        raise RuntimeError(f"Image download failed: HTTP {response.status_code}")
+    return response.content
+
+
+# The API response carries a multi-megabyte base64 string; orjson parses it much faster.
+def dump_json(payload: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode("utf-8")
+
+
+def load_json(body: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode("utf-8"))
+
+
 # Compose a consistent, detailed prompt for image generation.
 def format_tag_list(tags: list[str]) -> str:
+    return format_tag_tuple(tuple(tags))
+
+
+# Tag combinations repeat often and the formatting is pure, so memoize it.
+@lru_cache(maxsize=512)
+def format_tag_tuple(tags: tuple[str, ...]) -> str:
     if not tags:
         return ""
     if len(tags) == 1:
@@ -269,6 +351,7 @@ def log_prompt(selections: dict[str, list[str]]) -> None:
 
 # Keep saved images as album inputs for later generations.
 def save_album_image(image_path: str) -> None:
+    global _ALBUM_LISTING
     if not image_path:
         return
     source_path = os.path.join(APP_ROOT, "static", image_path)
@@ -276,25 +359,37 @@ def save_album_image(image_path: str) -> None:
         return
     album_name = f"album_{uuid.uuid4().hex}.png"
     destination_path = os.path.join(ALBUM_DIR, album_name)
-    copy2(source_path, destination_path)
+    # Generated files are never rewritten, so a hard link is a safe zero-copy save.
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        copy2(source_path, destination_path)
+    _ALBUM_LISTING = None
 
 
 def list_album_images(limit: int = 12) -> list[str]:
+    global _ALBUM_LISTING
     if not os.path.isdir(ALBUM_DIR):
         return []
-    files = [
-        filename
-        for filename in os.listdir(ALBUM_DIR)
-        if filename.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))
-    ]
-    files.sort(
-        key=lambda filename: os.path.getmtime(os.path.join(ALBUM_DIR, filename)),
-        reverse=True,
-    )
+    # Adding or removing a file bumps the directory mtime, so reuse the last scan until then.
+    mtime_ns = os.stat(ALBUM_DIR).st_mtime_ns
+    if _ALBUM_LISTING is not None and _ALBUM_LISTING[0] == mtime_ns:
+        files = _ALBUM_LISTING[1]
+    else:
+        with os.scandir(ALBUM_DIR) as entries:
+            candidates = [
+                (entry.stat().st_mtime, entry.name)
+                for entry in entries
+                if entry.is_file() and entry.name.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))
+            ]
+        candidates.sort(reverse=True)
+        files = [filename for _, filename in candidates]
+        _ALBUM_LISTING = (mtime_ns, files)
     return [f"album_images/{filename}" for filename in files[:limit]]
 
 
 def delete_album_image(image_path: str) -> None:
+    global _ALBUM_LISTING
     if not image_path:
         return
     filename = os.path.basename(image_path)
@@ -304,6 +399,7 @@ def delete_album_image(image_path: str) -> None:
     if not os.path.exists(target_path):
         return
     os.remove(target_path)
+    _ALBUM_LISTING = None
 
 
 init_storage()
@@ -323,14 +419,17 @@ def wait():
 
 
 @app.route("/generate_async", methods=["POST"])
-# Generate a fresh set of picks and request the corresponding image.
+# Generate a fresh set of picks and queue the corresponding image request.
 def generate_async():
-    selections = {}
     request_started = time.perf_counter()
     app.logger.info("generate_async started")
     try:
         inspiration_started = time.perf_counter()
-        selections = generate_inspiration()
+        # The log count drives the protagonist/villan cadence, so claim this request's slot
+        # before the next request reads it rather than when the pool thread gets to it.
+        with _INSPIRATION_LOCK:
+            selections = generate_inspiration()
+            log_prompt(selections)
         inspiration_elapsed_ms = (time.perf_counter() - inspiration_started) * 1000
         selection_counts = {key: len(value) for key, value in selections.items()}
         app.logger.info(
@@ -338,16 +437,44 @@ def generate_async():
             inspiration_elapsed_ms,
             selection_counts,
         )
-        generation_started = time.perf_counter()
-        image_path = generate_image(selections)
-        generation_elapsed_ms = (time.perf_counter() - generation_started) * 1000
+        prune_generation_jobs()
+        job_id = uuid.uuid4().hex
+        future = GENERATION_EXECUTOR.submit(run_generation_job, selections)
+        GENERATION_JOBS[job_id] = (future, request_started)
+    except Exception as exc:
         total_elapsed_ms = (time.perf_counter() - request_started) * 1000
-        app.logger.info(
-            "generate_async image ready duration_ms=%.0f total_ms=%.0f image_path=%s",
-            generation_elapsed_ms,
+        app.logger.exception(
+            "Unexpected error while queueing image generation total_ms=%.0f: %s",
             total_elapsed_ms,
-            image_path,
+            exc,
         )
+        return generation_failed("Unexpected error while generating a smile image.")
+    # Older cookies still carry these keys; nothing reads them any more.
+    session.pop("last_selection", None)
+    session.pop("pending_job", None)
+    # Clear the previous outcome so /image can never show it as this request's result.
+    session.pop("last_image", None)
+    session.pop("last_error", None)
+    # Several tabs may be waiting at once; keep the ids of this browser's live jobs.
+    pending_jobs = [job for job in session.get("pending_jobs", []) if job in GENERATION_JOBS]
+    session["pending_jobs"] = pending_jobs[-(MAX_PENDING_JOBS - 1):] + [job_id]
+    return {"status": "pending", "job_id": job_id}, 202
+
+
+@app.route("/generate_status/<job_id>")
+# Report on a queued image request and publish its result once finished.
+def generate_status(job_id):
+    job = GENERATION_JOBS.get(job_id)
+    if job is None or job_id not in session.get("pending_jobs", []):
+        # Leave the session alone: another tab may own the current result.
+        return {"status": "expired", "message": "This smile request has expired. Please try again."}, 404
+    future, request_started = job
+    if not future.done():
+        return {"status": "pending"}
+    GENERATION_JOBS.pop(job_id, None)
+    session["pending_jobs"] = [pending for pending in session["pending_jobs"] if pending != job_id]
+    try:
+        image_path = future.result()
     except RuntimeError as exc:
         total_elapsed_ms = (time.perf_counter() - request_started) * 1000
         app.logger.warning(
@@ -355,39 +482,63 @@ def generate_async():
             total_elapsed_ms,
             exc,
         )
-        session["last_error"] = str(exc)
-        session.pop("last_image", None)
-        session["last_selection"] = selections
-        return {"status": "error", "message": str(exc)}, 500
+        return generation_failed(str(exc))
     except Exception as exc:
         total_elapsed_ms = (time.perf_counter() - request_started) * 1000
-        session["last_error"] = "Unexpected error while generating a smile image."
-        session.pop("last_image", None)
-        session["last_selection"] = selections
         app.logger.exception(
             "Unexpected error during image generation total_ms=%.0f: %s",
             total_elapsed_ms,
             exc,
         )
-        return {"status": "error", "message": session["last_error"]}, 500
-    session["last_selection"] = selections
+        return generation_failed("Unexpected error while generating a smile image.")
+    total_elapsed_ms = (time.perf_counter() - request_started) * 1000
+    app.logger.info(
+        "generate_async finished total_ms=%.0f image_path=%s",
+        total_elapsed_ms,
+        image_path,
+    )
     session["last_image"] = image_path
     session.pop("last_error", None)
     return {"status": "ok"}
 
 
+# Runs on the generation pool so the request thread is free while the API renders.
+def run_generation_job(selections: dict[str, list[str]]) -> str:
+    generation_started = time.perf_counter()
+    image_path = generate_image(selections)
+    generation_elapsed_ms = (time.perf_counter() - generation_started) * 1000
+    app.logger.info(
+        "generate_async image ready duration_ms=%.0f image_path=%s",
+        generation_elapsed_ms,
+        image_path,
+    )
+    return image_path
+
+
+# Forget finished jobs whose browser never came back to collect them.
+def prune_generation_jobs() -> None:
+    now = time.perf_counter()
+    for job_id, (future, request_started) in list(GENERATION_JOBS.items()):
+        if future.done() and now - request_started > GENERATION_JOB_TTL_SECONDS:
+            GENERATION_JOBS.pop(job_id, None)
+
+
+def generation_failed(message: str):
+    session["last_error"] = message
+    session.pop("last_image", None)
+    return {"status": "error", "message": message}, 500
+
+
 @app.route("/image")
 def image():
     error = session.get("last_error")
     image_path = session.get("last_image")
-    selections = session.get("last_selection")
     if not error and not image_path:
         return redirect(url_for("index"))
     return render_template(
         "image.html",
         error=error,
         image_path=image_path,
-        selections=selections,
     )
 
 
@@ -412,5 +563,4 @@ def remove_album_image():
 
 
 if __name__ == "__main__":
-    init_storage()
     app.run(host="0.0.0.0", port=5000, debug=True)